@@ -5,12 +5,16 @@ or 2), a name (i.e., model name), and a CRS. The CRS is loaded using the
 model name and configuration file.
 """
 
-import json
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from utils import get_crs_model
 
-from src.model.utils import get_entity, get_options
+from src.model.utils import (
+    get_entities,
+    get_options,
+    load_entity2id,
+    load_id2entity,
+)
 
 if TYPE_CHECKING:
     from battle_manager import Message
@@ -39,6 +43,9 @@ class CRSFighter:
 
         # Load entity data
         self._load_entity_data()
+        # Entities extracted per utterance, so that the conversation history
+        # is not scanned again at every turn.
+        self._entity_cache: Dict[str, List[str]] = {}
 
         # Load options
         self.options = get_options(self.model.crs_model.kg_dataset)
@@ -54,14 +61,11 @@ class CRSFighter:
 
     def _load_entity_data(self):
         """Loads entity data."""
-        with open(
-            f"data/{self.model.crs_model.kg_dataset}/entity2id.json",
-            "r",
-            encoding="utf-8",
-        ) as f:
-            self.entity2id = json.load(f)
-
-        self.id2entity = {int(v): k for k, v in self.entity2id.items()}
+        entity2id_path = (
+            f"data/{self.model.crs_model.kg_dataset}/entity2id.json"
+        )
+        self.entity2id = load_entity2id(entity2id_path)
+        self.id2entity = load_id2entity(entity2id_path)
         self.entity_list = list(self.entity2id.keys())
 
     def _process_user_input(
@@ -85,10 +89,17 @@ class CRSFighter:
             Processed user input.
         """
         context = [m["message"] for m in history] + [input_message]
+        new_utterances = list(
+            dict.fromkeys(u for u in context if u not in self._entity_cache)
+        )
+        for utterance, utterance_entities in zip(
+            new_utterances, get_entities(new_utterances, self.entity_list)
+        ):
+            self._entity_cache[utterance] = utterance_entities
+
         entities = []
         for utterance in context:
-            utterance_entities = get_entity(utterance, self.entity_list)
-            entities.extend(utterance_entities)
+            entities.extend(self._entity_cache[utterance])
 
         return {
             "context": context,
@@ -0,0 +1,107 @@
+"""Exports the BARCOR recommendation and conversation models to ONNX.
+
+The exported models are loaded by BARCOR with the ONNX Runtime backend, i.e.,
+by setting `backend: ort` in its configuration with `rec_model` and
+`conv_model` pointing to the exported models.
+
+By default, the models are exported in FP32 without graph optimization. An
+ONNX Runtime optimization level can be given, from O1 (basic) to O4 (O3 with
+FP16 weights, GPU only).
+
+Usage:
+    python -m script.export_barcor_onnx \
+        --rec_model data/models/barcor_rec_redial/ \
+        --conv_model data/models/barcor_conv_redial/ \
+        --output_dir data/models/onnx/ \
+        [--optimization_level O4 --for_gpu]
+"""
+
+import argparse
+import os
+from typing import Optional
+
+from loguru import logger
+from optimum.onnxruntime import (
+    AutoOptimizationConfig,
+    ORTModelForSeq2SeqLM,
+    ORTModelForSequenceClassification,
+    ORTOptimizer,
+)
+
+OPTIMIZATION_LEVELS = ["O1", "O2", "O3", "O4"]
+
+
+def export_barcor_onnx(
+    rec_model: str,
+    conv_model: str,
+    output_dir: str,
+    optimization_level: Optional[str] = None,
+    for_gpu: bool = False,
+) -> None:
+    """Exports the BARCOR models to ONNX.
+
+    Each model is saved in a folder of the output directory named after the
+    folder of the original model.
+
+    Args:
+        rec_model: Path to the recommendation model.
+        conv_model: Path to the conversation model.
+        output_dir: Directory where the exported models are saved.
+        optimization_level: ONNX Runtime optimization level, one of O1, O2,
+          O3, or O4. Defaults to None, i.e., no optimization.
+        for_gpu: Whether the optimized models target GPU. Defaults to False.
+
+    Raises:
+        ValueError: If the optimization level is not supported, or if O4 is
+          used without targeting GPU.
+    """
+    if optimization_level is not None:
+        if optimization_level not in OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"Optimization level {optimization_level} is not supported, "
+                f"use one of {', '.join(OPTIMIZATION_LEVELS)}."
+            )
+        if optimization_level == "O4" and not for_gpu:
+            raise ValueError("Optimization level O4 (FP16) requires GPU.")
+
+    for model_class, model_path in [
+        (ORTModelForSequenceClassification, rec_model),
+        (ORTModelForSeq2SeqLM, conv_model),
+    ]:
+        export_path = os.path.join(
+            output_dir, os.path.basename(os.path.normpath(model_path))
+        )
+        logger.info(f"Exporting {model_path} to {export_path}.")
+        model = model_class.from_pretrained(model_path, export=True)
+        if optimization_level is None:
+            model.save_pretrained(export_path)
+            continue
+
+        logger.info(f"Optimizing {export_path} with {optimization_level}.")
+        optimizer = ORTOptimizer.from_pretrained(model)
+        optimizer.optimize(
+            save_dir=export_path,
+            optimization_config=AutoOptimizationConfig.with_optimization_level(
+                optimization_level, for_gpu=for_gpu
+            ),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rec_model", type=str, required=True)
+    parser.add_argument("--conv_model", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default="data/models/onnx")
+    parser.add_argument(
+        "--optimization_level", type=str, choices=OPTIMIZATION_LEVELS
+    )
+    parser.add_argument("--for_gpu", action="store_true")
+    args = parser.parse_args()
+
+    export_barcor_onnx(
+        args.rec_model,
+        args.conv_model,
+        args.output_dir,
+        optimization_level=args.optimization_level,
+        for_gpu=args.for_gpu,
+    )
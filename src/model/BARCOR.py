@@ -1,17 +1,17 @@
-import json
 import sys
 from collections import defaultdict
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
-from accelerate import Accelerator
 from accelerate.utils import set_seed
+from loguru import logger
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
 sys.path.append("..")
 
 from src.model.barcor.barcor_model import BartForSequenceClassification
 from src.model.barcor.kg_bart import KGForBART
+from src.model.utils import get_accelerator, get_autocast, load_entity2id
 
 
 class BARCOR:
@@ -25,6 +25,10 @@ class BARCOR:
         rec_model,
         conv_model,
         resp_max_length,
+        dtype="fp16",
+        compile_rec_model=False,
+        quantize_rec_model=False,
+        backend="torch",
     ):
         self.seed = seed
         if self.seed is not None:
@@ -33,16 +37,41 @@ class BARCOR:
 
         self.debug = debug
         self.tokenizer_path = tokenizer_path
-        self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path)
-        self.tokenizer.truncation_side = "left"
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.tokenizer_path, use_fast=True, truncation_side="left"
+        )
+        if not self.tokenizer.is_fast:
+            logger.warning(
+                f"No fast tokenizer available for {self.tokenizer_path}, "
+                "falling back to the slow tokenizer."
+            )
+        self.sep_token = self.tokenizer.sep_token
+        # Prefixes of the utterances, turns alternate starting with the user.
+        self.role_prefixes = ("User: ", "System: ")
         self.context_max_length = context_max_length
+        # Token ids of the option letters, keyed by the options.
+        self.option_token_ids: Dict[Tuple[str, ...], torch.Tensor] = {}
+        # Index of the decoding step from which the option is read.
+        self.choice_step = 3
 
-        self.padding = "max_length"
+        self.padding = "longest"
         self.pad_to_multiple_of = 8
 
-        self.accelerator = Accelerator(
-            device_placement=False, mixed_precision="fp16"
-        )
+        # Precision used for inference, one of "fp32", "fp16", or "bf16". It
+        # sets the autocast and weights dtype of the models.
+        torch_dtypes = {
+            "fp32": torch.float32,
+            "fp16": torch.float16,
+            "bf16": torch.bfloat16,
+        }
+        if dtype not in torch_dtypes:
+            raise ValueError(
+                f"Dtype {dtype} is not supported, use fp32, fp16, or bf16."
+            )
+        self.dtype = dtype
+        self.torch_dtype = torch_dtypes[self.dtype]
+
+        self.accelerator = get_accelerator()
         self.device = self.accelerator.device
 
         self.rec_model = rec_model
@@ -54,41 +83,168 @@ class BARCOR:
         self.kg = KGForBART(
             kg_dataset=self.kg_dataset, debug=self.debug
         ).get_kg_info()
+        self.item_ids = torch.as_tensor(
+            self.kg["item_ids"], device=self.device, dtype=torch.long
+        )
 
+        # Inference backend, either "torch" or "ort" (ONNX Runtime).
+        if backend not in ["torch", "ort"]:
+            raise ValueError(
+                f"Backend {backend} is not supported, use torch or ort."
+            )
+        self.backend = backend
+        if self.backend == "ort":
+            ignored_args = [
+                name
+                for name, is_set in [
+                    ("dtype", dtype != "fp16"),
+                    ("compile_rec_model", compile_rec_model),
+                    ("quantize_rec_model", quantize_rec_model),
+                ]
+                if is_set
+            ]
+            if ignored_args:
+                logger.warning(
+                    f"{', '.join(ignored_args)} only apply to the PyTorch "
+                    "backend and are ignored with ONNX Runtime."
+                )
+            self._load_ort_models()
+        else:
+            self._load_torch_models(compile_rec_model, quantize_rec_model)
+
+        self.kg_dataset_path = f"data/{self.kg_dataset}"
+        self.entity2id = load_entity2id(
+            f"{self.kg_dataset_path}/entity2id.json"
+        )
+
+    def _load_torch_models(
+        self, compile_rec_model: bool, quantize_rec_model: bool
+    ) -> None:
+        """Loads the recommendation and conversation models with PyTorch.
+
+        Args:
+            compile_rec_model: Whether to compile the recommendation model.
+            quantize_rec_model: Whether to quantize the recommendation model
+              to INT8. Only applies on CPU, where the weights are loaded in
+              FP32 and autocast is disabled whatever the dtype.
+        """
+        # Half precision weights are only used on GPU, CPU inference and
+        # quantization require FP32 weights.
+        load_dtype = (
+            self.torch_dtype if self.device.type == "cuda" else torch.float32
+        )
         self.crs_rec_model = BartForSequenceClassification.from_pretrained(
-            self.rec_model, num_labels=self.kg["num_entities"]
+            self.rec_model,
+            num_labels=self.kg["num_entities"],
+            low_cpu_mem_usage=True,
+            torch_dtype=load_dtype,
         ).to(self.device)
+        if quantize_rec_model:
+            if self.device.type == "cpu":
+                # INT8 weights for the linear layers, including the
+                # classification head over all the entities.
+                self.crs_rec_model = torch.ao.quantization.quantize_dynamic(
+                    self.crs_rec_model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            else:
+                logger.warning(
+                    "Dynamic quantization is only supported on CPU, the "
+                    "recommendation model is not quantized."
+                )
+        if compile_rec_model:
+            if hasattr(torch, "compile"):
+                self.crs_rec_model = torch.compile(
+                    self.crs_rec_model, mode="reduce-overhead", dynamic=True
+                )
+            else:
+                logger.warning(
+                    "torch.compile requires PyTorch 2.0 or later, the "
+                    "recommendation model is not compiled."
+                )
         self.crs_conv_model = AutoModelForSeq2SeqLM.from_pretrained(
-            self.conv_model
+            self.conv_model, low_cpu_mem_usage=True, torch_dtype=load_dtype
         ).to(self.device)
-        self.crs_conv_model = self.accelerator.prepare(self.crs_conv_model)
+        self.crs_rec_model.eval()
+        self.crs_conv_model.eval()
 
-        self.kg_dataset_path = f"data/{self.kg_dataset}"
-        with open(
-            f"{self.kg_dataset_path}/entity2id.json", "r", encoding="utf-8"
-        ) as f:
-            self.entity2id = json.load(f)
+    def _load_ort_models(self) -> None:
+        """Loads the recommendation and conversation models with ONNX Runtime.
+
+        The models are expected to be exported with
+        `script/export_barcor_onnx.py`.
+
+        Raises:
+            ImportError: If optimum[onnxruntime] is not installed.
+        """
+        try:
+            from optimum.onnxruntime import (
+                ORTModelForSeq2SeqLM,
+                ORTModelForSequenceClassification,
+            )
+        except ImportError as e:
+            raise ImportError(
+                "The ort backend requires optimum[onnxruntime], install it "
+                "with `pip install optimum[onnxruntime]`."
+            ) from e
+
+        provider = (
+            "CUDAExecutionProvider"
+            if self.device.type == "cuda"
+            else "CPUExecutionProvider"
+        )
+        self.crs_rec_model = ORTModelForSequenceClassification.from_pretrained(
+            self.rec_model, provider=provider
+        )
+        self.crs_conv_model = ORTModelForSeq2SeqLM.from_pretrained(
+            self.conv_model, provider=provider
+        )
+
+    def _build_context(self, conv_dict: Dict[str, Any]) -> str:
+        """Builds the model input from the utterances of a conversation.
+
+        Args:
+            conv_dict: Conversation context.
+
+        Returns:
+            Non-empty utterances with their role prefix, joined by the
+            separator token.
+        """
+        return self.sep_token.join(
+            [
+                self.role_prefixes[turn_idx % 2] + utt
+                for turn_idx, utt in enumerate(conv_dict["context"])
+                if utt != ""
+            ]
+        )
+
+    def _to_device(
+        self, tensors: Dict[str, torch.Tensor]
+    ) -> Dict[str, torch.Tensor]:
+        """Moves tensors to the device.
+
+        On GPU, the tensors are copied from pinned memory without blocking.
+        """
+        if self.device.type == "cuda":
+            return {
+                k: v.pin_memory().to(self.device, non_blocking=True)
+                for k, v in tensors.items()
+            }
+        return {k: v.to(self.device) for k, v in tensors.items()}
+
+    def _autocast(self):
+        """Returns an autocast context for the configured precision.
+
+        Autocast is only enabled on GPU, inference on CPU runs in FP32.
+        """
+        return get_autocast(self.device, self.torch_dtype)
 
-    def get_rec(self, conv_dict):
+    @torch.inference_mode()
+    def get_rec(self, conv_dict, k=50):
         # dataset
-        text_list = []
-        turn_idx = 0
-
-        for utt in conv_dict["context"]:
-            if utt != "":
-                text = ""
-                if turn_idx % 2 == 0:
-                    text += "User: "
-                else:
-                    text += "System: "
-                text += utt
-                text_list.append(text)
-            turn_idx += 1
-
-        context = f"{self.tokenizer.sep_token}".join(text_list)
-        context_ids = self.tokenizer.encode(
+        context = self._build_context(conv_dict)
+        context_ids = self.tokenizer(
             context, truncation=True, max_length=self.context_max_length
-        )
+        )["input_ids"]
 
         data_list = []
 
@@ -132,91 +288,62 @@ class BARCOR:
 
         input_dict = self.tokenizer.pad(
             input_dict,
-            max_length=self.context_max_length,
             padding=self.padding,
             pad_to_multiple_of=self.pad_to_multiple_of,
+            return_tensors="pt",
         )
+        input_dict = self._to_device(input_dict)
 
-        if len(label_list) > 0:
-            input_dict["labels"] = label_list
-
-        for k, v in input_dict.items():
-            if not isinstance(v, torch.Tensor):
-                input_dict[k] = torch.as_tensor(v, device=self.device)
-
-        labels = (
-            input_dict["labels"].tolist() if "labels" in input_dict else None
-        )
-        self.crs_rec_model.eval()
-        outputs = self.crs_rec_model(**input_dict)
-        item_ids = torch.as_tensor(self.kg["item_ids"], device=self.device)
-        logits = outputs["logits"][:, item_ids]
-        ranks = torch.topk(logits, k=50, dim=-1).indices
-        preds = item_ids[ranks].tolist()
+        # The labels are only returned, the loss is not needed for inference.
+        labels = label_list if len(label_list) > 0 else None
+        with self._autocast():
+            outputs = self.crs_rec_model(**input_dict)
+        # Rank in FP32 to avoid overflow of half precision logits
+        logits = outputs["logits"][:, self.item_ids].float()
+        ranks = torch.topk(logits, k=k, dim=-1).indices
+        preds = self.item_ids[ranks].tolist()
 
         return preds, labels
 
+    @torch.inference_mode()
     def get_conv(self, conv_dict):
-        text_list = []
-        turn_idx = 0
-        for utt in conv_dict["context"]:
-            if utt != "":
-                text = ""
-                if turn_idx % 2 == 0:
-                    text += "User: "
-                else:
-                    text += "System: "
-                text += utt
-                text_list.append(text)
-            turn_idx += 1
-        context = f"{self.tokenizer.sep_token}".join(text_list)
-        context_ids = self.tokenizer.encode(
+        context = self._build_context(conv_dict)
+        context_ids = self.tokenizer(
             context, truncation=True, max_length=self.context_max_length
-        )
+        )["input_ids"]
 
-        if turn_idx % 2 == 0:
-            user_str = "User: "
-        else:
-            user_str = "System: "
-        resp = user_str + conv_dict["resp"]
-        resp_ids = self.tokenizer.encode(
+        resp = self.role_prefixes[len(conv_dict["context"]) % 2]
+        resp += conv_dict["resp"]
+        resp_ids = self.tokenizer(
             resp, truncation=True, max_length=self.resp_max_length
-        )
+        )["input_ids"]
 
         data_dict = {
             "context": context_ids,
             "resp": resp_ids,
         }
 
-        input_dict = defaultdict(list)
-        label_dict = defaultdict(list)
-
-        input_dict["input_ids"] = data_dict["context"]
-        label_dict["input_ids"] = data_dict["resp"]
+        # Batches of a single example
+        input_dict = {"input_ids": [data_dict["context"]]}
+        label_dict = {"input_ids": [data_dict["resp"]]}
 
         input_dict = self.tokenizer.pad(
             input_dict,
-            max_length=self.context_max_length,
             padding=self.padding,
             pad_to_multiple_of=self.pad_to_multiple_of,
+            return_tensors="pt",
         )
 
         label_dict = self.tokenizer.pad(
             label_dict,
-            max_length=self.context_max_length,
             padding=self.padding,
             pad_to_multiple_of=self.pad_to_multiple_of,
+            return_tensors="pt",
         )["input_ids"]
 
         input_dict["labels"] = label_dict
 
-        for k, v in input_dict.items():
-            if not isinstance(v, torch.Tensor):
-                input_dict[k] = torch.as_tensor(
-                    v, device=self.device
-                ).unsqueeze(0)
-
-        self.crs_conv_model.eval()
+        input_dict = self._to_device(input_dict)
 
         gen_args = {
             "min_length": 0,
@@ -226,27 +353,113 @@ class BARCOR:
             "encoder_no_repeat_ngram_size": 3,
         }
 
-        gen_seqs = self.accelerator.unwrap_model(self.crs_conv_model).generate(
-            **input_dict, **gen_args
-        )
+        conv_model = self.crs_conv_model
+        with self._autocast():
+            if self.backend == "torch":
+                # Encode the context once, the encoder outputs are reused by
+                # generate here and in get_choice.
+                input_dict["encoder_outputs"] = conv_model.get_encoder()(
+                    input_ids=input_dict["input_ids"],
+                    attention_mask=input_dict["attention_mask"],
+                    return_dict=True,
+                )
+            gen_seqs = conv_model.generate(**input_dict, **gen_args)
         gen_str = self.tokenizer.decode(gen_seqs[0], skip_special_tokens=True)
+        # Kept to score the options in get_choice without decoding again.
+        input_dict["response_ids"] = gen_seqs
 
         return input_dict, gen_str
 
+    def _get_choice_logits_from_response(
+        self, conv_model, gen_inputs: Dict[str, Any]
+    ) -> Optional[torch.Tensor]:
+        """Computes the logits of the choice step from the generated response.
+
+        The option is read at the decoding step following the response prefix
+        (i.e., "<s>System:"). If the response generated by get_conv starts with
+        the prefix that greedy decoding of the choice would produce, a single
+        decoder pass over this prefix gives the logits of the choice step.
+
+        These logits are raw, the logits processors of generate are skipped.
+        On the choice step, the processors of the generate fallback in
+        get_choice mask EOS and block repeated n-grams, which cannot hit an
+        option token after the prefix, so both paths give the same scores for
+        the option tokens.
+
+        Args:
+            conv_model: Unwrapped conversation model.
+            gen_inputs: Generation inputs returned by get_conv.
+
+        Returns:
+            Logits of the choice step, or None if the response cannot be
+            reused.
+        """
+        response_ids = gen_inputs.get("response_ids")
+        if (
+            response_ids is None
+            or "encoder_outputs" not in gen_inputs
+            or response_ids.shape[1] <= self.choice_step
+        ):
+            return None
+
+        # Decoder start token followed by the tokens preceding the choice.
+        prefix_ids = response_ids[:, : self.choice_step + 1]
+        if (prefix_ids[:, 1:] == conv_model.config.eos_token_id).any():
+            return None
+
+        logits = conv_model(
+            attention_mask=gen_inputs["attention_mask"],
+            encoder_outputs=gen_inputs["encoder_outputs"],
+            decoder_input_ids=prefix_ids,
+        ).logits
+
+        # Greedy decoding of the choice must yield the same prefix, only the
+        # first token may be forced by the generation config.
+        matches = logits[:, :-1].argmax(dim=-1) == prefix_ids[:, 1:]
+        forced_bos_token_id = conv_model.generation_config.forced_bos_token_id
+        if forced_bos_token_id is not None:
+            matches[:, 0] = prefix_ids[:, 1] == forced_bos_token_id
+        if not matches.all():
+            return None
+
+        return logits[:, -1]
+
+    @torch.inference_mode()
     def get_choice(self, gen_inputs, options, state, conv_dict=None):
-        outputs = self.accelerator.unwrap_model(self.crs_conv_model).generate(
-            **gen_inputs,
-            min_new_tokens=5,
-            max_new_tokens=5,
-            num_beams=1,
-            return_dict_in_generate=True,
-            output_scores=True,
+        conv_model = self.crs_conv_model
+        with self._autocast():
+            choice_logits = self._get_choice_logits_from_response(
+                conv_model, gen_inputs
+            )
+            if choice_logits is None:
+                outputs = conv_model.generate(
+                    **{
+                        k: v
+                        for k, v in gen_inputs.items()
+                        if k != "response_ids"
+                    },
+                    min_new_tokens=self.choice_step + 1,
+                    max_new_tokens=self.choice_step + 1,
+                    # The choice step is the last generated one, EOS must not
+                    # be forced on it by the generation config.
+                    forced_eos_token_id=None,
+                    num_beams=1,
+                    return_dict_in_generate=True,
+                    output_scores=True,
+                )
+                choice_logits = outputs.scores[-1]
+
+        option_token_ids = self.option_token_ids.get(tuple(options))
+        if option_token_ids is None:
+            token_ids = [
+                self.tokenizer.encode(f" {op}", add_special_tokens=False)[0]
+                for op in options
+            ]
+            option_token_ids = torch.as_tensor(token_ids, device=self.device)
+            self.option_token_ids[tuple(options)] = option_token_ids
+        option_scores = (
+            choice_logits[0].index_select(0, option_token_ids).float()
         )
-        option_token_ids = [
-            self.tokenizer.encode(f" {op}", add_special_tokens=False)[0]
-            for op in options
-        ]
-        option_scores = outputs.scores[-2][0][option_token_ids]
         state = torch.as_tensor(
             state, device=self.device, dtype=option_scores.dtype
         )
@@ -281,9 +494,9 @@ class BARCOR:
 
         if choice == options_letter[-1]:
             # Generate a recommendation
-            recommended_items, _ = self.get_rec(conv_dict)
+            recommended_items, _ = self.get_rec(conv_dict, k=3)
             recommended_items_str = ""
-            for i, item_id in enumerate(recommended_items[0][:3]):
+            for i, item_id in enumerate(recommended_items[0]):
                 recommended_items_str += f"{i+1}: {id2entity[item_id]}  \n"
             response = (
                 "I would recommend the following items:  \n"
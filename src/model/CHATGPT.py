@@ -15,6 +15,8 @@ from tenacity.stop import stop_base
 from tenacity.wait import wait_base
 from tqdm import tqdm
 
+from src.model.utils import load_entity2id
+
 
 def my_before_sleep(retry_state):
     logger.debug(
@@ -139,10 +141,9 @@ class CHATGPT:
         self.kg_dataset = kg_dataset
 
         self.kg_dataset_path = f"data/{self.kg_dataset}"
-        with open(
-            f"{self.kg_dataset_path}/entity2id.json", "r", encoding="utf-8"
-        ) as f:
-            self.entity2id = json.load(f)
+        self.entity2id = load_entity2id(
+            f"{self.kg_dataset_path}/entity2id.json"
+        )
         with open(
             f"{self.kg_dataset_path}/id2info.json", "r", encoding="utf-8"
         ) as f:
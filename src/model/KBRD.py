@@ -1,10 +1,8 @@
-import json
 import sys
 from collections import defaultdict
 from typing import Any, Dict, List, Tuple
 
 import torch
-from accelerate import Accelerator
 from accelerate.utils import set_seed
 from transformers import AutoTokenizer, BartConfig
 
@@ -12,7 +10,12 @@ sys.path.append("..")
 
 from src.model.kbrd.kbrd_model import KBRDforConv, KBRDforRec
 from src.model.kbrd.kg_kbrd import KGForKBRD
-from src.model.utils import padded_tensor
+from src.model.utils import (
+    get_accelerator,
+    get_autocast,
+    load_entity2id,
+    padded_tensor,
+)
 
 
 class KBRD:
@@ -61,15 +64,12 @@ class KBRD:
         self.pad_to_multiple_of = 8
 
         self.kg_dataset_path = f"data/{self.kg_dataset}"
-        with open(
-            f"{self.kg_dataset_path}/entity2id.json", "r", encoding="utf-8"
-        ) as f:
-            self.entity2id = json.load(f)
+        self.entity2id = load_entity2id(
+            f"{self.kg_dataset_path}/entity2id.json"
+        )
 
         # Initialize the accelerator.
-        self.accelerator = Accelerator(
-            device_placement=False, mixed_precision="fp16"
-        )
+        self.accelerator = get_accelerator()
         self.device = self.accelerator.device
 
         self.kg = KGForKBRD(
@@ -87,7 +87,6 @@ class KBRD:
         if self.rec_model is not None:
             self.crs_rec_model.load(self.rec_model)
         self.crs_rec_model = self.crs_rec_model.to(self.device)
-        self.crs_rec_model = self.accelerator.prepare(self.crs_rec_model)
 
         # conv model
         config = BartConfig.from_pretrained(
@@ -110,7 +109,6 @@ class KBRD:
             self.crs_conv_model = KBRDforConv.from_pretrained(
                 self.conv_model, user_hidden_size=self.entity_hidden_size
             ).to(self.device)
-        self.crs_conv_model = self.accelerator.prepare(self.crs_conv_model)
 
     def get_rec(self, conv_dict):
         data_dict = {
@@ -161,11 +159,12 @@ class KBRD:
         with torch.no_grad():
             data_dict["entity"]["edge_index"] = edge_index
             data_dict["entity"]["edge_type"] = edge_type
-            outputs = self.crs_rec_model(
-                **data_dict["entity"], reduction="mean"
-            )
+            with get_autocast(self.device):
+                outputs = self.crs_rec_model(
+                    **data_dict["entity"], reduction="mean"
+                )
 
-            logits = outputs["logit"][:, self.kg["item_ids"]]
+            logits = outputs["logit"][:, self.kg["item_ids"]].float()
             ranks = torch.topk(logits, k=50, dim=-1).indices.tolist()
             preds = [
                 [self.kg["item_ids"][rank] for rank in rank_list]
@@ -242,9 +241,11 @@ class KBRD:
         ), torch.as_tensor(self.kg["edge_type"], device=self.device)
 
         node_embeds = self.crs_rec_model.get_node_embeds(edge_index, edge_type)
-        user_embeds = self.crs_rec_model(
-            **data_dict["entity"], node_embeds=node_embeds
-        )["user_embeds"]
+        with get_autocast(self.device):
+            user_embeds = self.crs_rec_model(
+                **data_dict["entity"], node_embeds=node_embeds
+            )["user_embeds"]
+        user_embeds = user_embeds.float()
 
         gen_inputs = {
             **data_dict["context"],
@@ -259,15 +260,13 @@ class KBRD:
             "no_repeat_ngram_size": 3,
             "encoder_no_repeat_ngram_size": 3,
         }
-        gen_seqs = self.accelerator.unwrap_model(self.crs_conv_model).generate(
-            **gen_inputs, **gen_args
-        )
+        gen_seqs = self.crs_conv_model.generate(**gen_inputs, **gen_args)
         gen_str = self.tokenizer.decode(gen_seqs[0], skip_special_tokens=True)
         return gen_inputs, gen_str
 
     def get_choice(self, gen_inputs, options, state, conv_dict=None):
         state = torch.as_tensor(state, device=self.device)
-        outputs = self.accelerator.unwrap_model(self.crs_conv_model).generate(
+        outputs = self.crs_conv_model.generate(
             **gen_inputs,
             min_new_tokens=2,
             max_new_tokens=2,
@@ -1,11 +1,9 @@
-import json
 import logging
 import sys
 from collections import defaultdict
 from typing import Any, Dict, List, Tuple
 
 import torch
-from accelerate import Accelerator
 from accelerate.utils import set_seed
 from transformers import AutoModel, AutoTokenizer
 
@@ -15,7 +13,12 @@ from src.model.unicrs.config import get_special_tokens_dict
 from src.model.unicrs.kg_unicrs import KGForUniCRS
 from src.model.unicrs.model_gpt2 import PromptGPT2forCRS
 from src.model.unicrs.model_prompt import KGPrompt
-from src.model.utils import padded_tensor
+from src.model.utils import (
+    get_accelerator,
+    get_autocast,
+    load_entity2id,
+    padded_tensor,
+)
 
 
 class UNICRS:
@@ -40,9 +43,7 @@ class UNICRS:
 
         self.debug = debug
 
-        self.accelerator = Accelerator(
-            device_placement=False, mixed_precision="fp16"
-        )
+        self.accelerator = get_accelerator()
         self.device = self.accelerator.device
 
         self.context_max_length = context_max_length
@@ -94,10 +95,9 @@ class UNICRS:
             self.kg["item_ids"], device=self.device
         )
         self.kg_dataset_path = f"data/{self.kg_dataset}"
-        with open(
-            f"{self.kg_dataset_path}/entity2id.json", "r", encoding="utf-8"
-        ) as f:
-            self.entity2id = json.load(f)
+        self.entity2id = load_entity2id(
+            f"{self.kg_dataset_path}/entity2id.json"
+        )
         self.entity_pad_id = self.kg["pad_entity_id"]
 
         self.num_bases = num_bases
@@ -117,9 +117,6 @@ class UNICRS:
         if rec_model is not None:
             self.rec_prompt_encoder.load(self.rec_model_path)
         self.rec_prompt_encoder = self.rec_prompt_encoder.to(self.device)
-        self.rec_prompt_encoder = self.accelerator.prepare(
-            self.rec_prompt_encoder
-        )
 
         # prompt for conv
         self.conv_prompt_encoder = KGPrompt(
@@ -137,9 +134,6 @@ class UNICRS:
         if conv_model is not None:
             self.conv_prompt_encoder.load(self.conv_model_path)
         self.conv_prompt_encoder = self.conv_prompt_encoder.to(self.device)
-        self.conv_prompt_encoder = self.accelerator.prepare(
-            self.conv_prompt_encoder
-        )
 
     def get_rec(self, conv_dict):
         text_list = []
@@ -257,12 +251,13 @@ class UNICRS:
         token_embeds = self.text_encoder(
             **input_batch["prompt"]
         ).last_hidden_state
-        prompt_embeds = self.rec_prompt_encoder(
-            entity_ids=input_batch["entity"],
-            token_embeds=token_embeds,
-            output_entity=True,
-        )
-        input_batch["context"]["prompt_embeds"] = prompt_embeds
+        with get_autocast(self.device):
+            prompt_embeds = self.rec_prompt_encoder(
+                entity_ids=input_batch["entity"],
+                token_embeds=token_embeds,
+                output_entity=True,
+            )
+        input_batch["context"]["prompt_embeds"] = prompt_embeds.float()
         input_batch["context"][
             "entity_embeds"
         ] = self.rec_prompt_encoder.get_entity_embeds()
@@ -407,13 +402,14 @@ class UNICRS:
         token_embeds = self.text_encoder(
             **input_batch["prompt"]
         ).last_hidden_state
-        prompt_embeds = self.conv_prompt_encoder(
-            entity_ids=input_batch["entity"],
-            token_embeds=token_embeds,
-            output_entity=False,
-            use_conv_prefix=True,
-        )
-        input_batch["context"]["prompt_embeds"] = prompt_embeds
+        with get_autocast(self.device):
+            prompt_embeds = self.conv_prompt_encoder(
+                entity_ids=input_batch["entity"],
+                token_embeds=token_embeds,
+                output_entity=False,
+                use_conv_prefix=True,
+            )
+        input_batch["context"]["prompt_embeds"] = prompt_embeds.float()
 
         gen_args = {
             "max_new_tokens": self.resp_max_length,
@@ -427,7 +423,7 @@ class UNICRS:
 
     def get_choice(self, gen_inputs, options, state, conv_dict=None):
         state = torch.as_tensor(state, device=self.device)
-        outputs = self.accelerator.unwrap_model(self.model).generate(
+        outputs = self.model.generate(
             **gen_inputs["context"],
             min_new_tokens=1,
             max_new_tokens=1,
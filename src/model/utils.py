@@ -1,8 +1,21 @@
 import json
 import random
-from typing import Dict, List, Optional, Tuple, Union
-
+from contextlib import nullcontext
+from functools import lru_cache
+from types import MappingProxyType
+from typing import (
+    ContextManager,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import numpy as np
 import torch
+from accelerate import Accelerator
 from rapidfuzz import fuzz, process
 from torch import nn
 from torch.nn import functional as F
@@ -19,6 +32,75 @@ def load_jsonl_data(file):
     return data_list
 
 
+@lru_cache(maxsize=None)
+def get_accelerator() -> Accelerator:
+    """Returns the accelerator shared by all the CRS models of the process.
+
+    The accelerator state is global to the process, so a single accelerator
+    is created. It uses FP16 mixed precision on GPU and none on CPU. Models
+    must not be prepared with it, as it would keep a reference to them, use
+    get_autocast for mixed precision instead.
+
+    Returns:
+        Accelerator without device placement.
+    """
+    return Accelerator(
+        device_placement=False,
+        mixed_precision="fp16" if torch.cuda.is_available() else "no",
+    )
+
+
+def get_autocast(
+    device: torch.device, dtype: torch.dtype = torch.float16
+) -> ContextManager:
+    """Returns an autocast context for inference on the given device.
+
+    Autocast is only enabled on GPU with a half precision dtype, otherwise a
+    null context is returned and inference runs in FP32.
+
+    Args:
+        device: Device the model runs on.
+        dtype: Autocast dtype. Defaults to FP16.
+
+    Returns:
+        Context manager.
+    """
+    if device.type == "cuda" and dtype != torch.float32:
+        return torch.autocast(device_type="cuda", dtype=dtype)
+    return nullcontext()
+
+
+@lru_cache(maxsize=None)
+def load_entity2id(path: str) -> Mapping[str, int]:
+    """Loads a mapping from entity name to entity id.
+
+    The mapping is cached and shared between callers, hence it is read-only.
+
+    Args:
+        path: Path to the entity2id JSON file.
+
+    Returns:
+        Read-only mapping from entity name to entity id.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return MappingProxyType(json.load(f))
+
+
+@lru_cache(maxsize=None)
+def load_id2entity(path: str) -> Mapping[int, str]:
+    """Loads a mapping from entity id to entity name.
+
+    Args:
+        path: Path to the entity2id JSON file.
+
+    Returns:
+        Read-only mapping from entity id to entity name.
+    """
+    return MappingProxyType(
+        {int(v): k for k, v in load_entity2id(path).items()}
+    )
+
+
 def simple_collate(batch):
     return batch
 
@@ -145,6 +227,35 @@ def get_entity(text, entity_list):
     return extractions
 
 
+def get_entities(texts: List[str], entity_list: List[str]) -> List[List[str]]:
+    """Extracts entities from several texts at once.
+
+    Gives the same entities as calling `get_entity` on each text, but all the
+    texts are scored against the entity list in a single batched call.
+
+    Args:
+        texts: Texts to extract entities from.
+        entity_list: List of entities.
+
+    Returns:
+        A list with the extracted entities for each text.
+    """
+    if len(texts) == 0:
+        return []
+
+    scores = process.cdist(
+        texts, entity_list, scorer=fuzz.WRatio, score_cutoff=90, workers=-1
+    )
+    extractions = []
+    for text_scores in scores:
+        entity_idx = np.flatnonzero(text_scores)
+        entity_idx = entity_idx[
+            np.argsort(-text_scores[entity_idx], kind="stable")
+        ][:20]
+        extractions.append([entity_list[i] for i in entity_idx])
+    return extractions
+
+
 def get_options(dataset: str) -> Tuple[str, Dict[str, str]]:
     """Returns the possible options for a given dataset.
 